@@ -1,14 +1,19 @@
-import pytz
+import cbor2
+import hashlib
 import requests
+import altair as alt
 import pandas as pd
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from elasticsearch import Elasticsearch
+from elasticsearch.serializer import OrjsonSerializer, Serializer
 from zoneinfo import ZoneInfo
 from datetime import datetime
 from streamlit_autorefresh import st_autorefresh
 from streamlit_extras.stylable_container import stylable_container
 from elasticsearch.exceptions import AuthenticationException
 from streamlit.connections import ExperimentalBaseConnection
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # === Constants ===
 ELASTIC_CLOUD_ID = st.secrets["ELASTICSEARCH_CLOUD_ID"]
@@ -18,47 +23,164 @@ ELASTIC_AUTH_BASE_URL = st.secrets["ELASTIC_AUTH_BASE_URL"]
 LOGOUT_URL = st.secrets["LOGOUT_URL"]
 AUTH_NONCE = st.secrets["AUTH_NONCE"]
 TIME_ZONE = st.secrets["TIME_ZONE"]
+TZ = ZoneInfo(TIME_ZONE)
+# Half the default 10 second refresh, so a session's next tick always misses
+QUERY_CACHE_TTL = 5
+QUERY_CACHE_MAX_ENTRIES = 256
+QUERY_WORKERS = 16
+CONNECTION_TTL = 3600
+
+# Nullable pandas dtypes for the numeric Elasticsearch SQL column types
+SQL_DTYPES = {
+    "byte": "Int64",
+    "short": "Int64",
+    "integer": "Int64",
+    "long": "Int64",
+    "half_float": "Float64",
+    "float": "Float64",
+    "scaled_float": "Float64",
+    "double": "Float64",
+}
 
 
 # === Elasticsearch Connection Wrapper ===
+class CborSerializer(Serializer):
+    mimetype = "application/cbor"
+
+    def loads(self, data):
+        return cbor2.loads(data)
+
+    def dumps(self, data):
+        return cbor2.dumps(data)
+
+
 class ElasticConnection(ExperimentalBaseConnection[Elasticsearch]):
     def __init__(self, connection_name: str, access_token: str, **kwargs):
         self.access_token = access_token
+        # Results are cached across sessions, so key them on who asked: each
+        # token only sees what its user's Elasticsearch privileges allow
+        self._user = hashlib.sha256(access_token.encode()).hexdigest()
         super().__init__(connection_name, **kwargs)
 
     def _connect(self) -> Elasticsearch:
         return Elasticsearch(
-            cloud_id=st.secrets["ELASTICSEARCH_CLOUD_ID"],
-            headers={
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/vnd.elasticsearch+json;compatible-with=8",
-                "Accept": "application/vnd.elasticsearch+json;compatible-with=8",
+            cloud_id=ELASTIC_CLOUD_ID,
+            bearer_auth=self.access_token,
+            serializers={
+                CborSerializer.mimetype: CborSerializer(),
+                OrjsonSerializer.mimetype: OrjsonSerializer(),
             },
+            http_compress=True,
+            # Enough keep-alive connections for every query worker to hold one
+            connections_per_node=QUERY_WORKERS,
+            # Fail a stalled query quickly; the next autorefresh tick retries it
+            request_timeout=5,
+            max_retries=0,
+            retry_on_timeout=False,
         )
 
     @property
     def client(self) -> Elasticsearch:
         return self._instance
 
-    def query(self, query, filter):
-        try:
+    def _cached(self, fn, ttl):
+        # Scope the cache to this connection and ttl, as Streamlit's own
+        # SQLConnection does, so a different ttl doesn't reset it. The name
+        # has to be set before decorating, as the cache key is taken from it.
+        fn.__qualname__ = f"{fn.__qualname__}_{self._connection_name}_{ttl}"
+        cached_fn = st.cache_data(
+            ttl=ttl, max_entries=QUERY_CACHE_MAX_ENTRIES, show_spinner=False
+        )(fn)
+
+        def call(*args):
+            try:
+                # fn takes the user first, so results are cached per user
+                return cached_fn(self._user, *args)
+            except AuthenticationException:
+                # An expired token fails every query the same way; let the
+                # caller refresh it once rather than rendering each widget as "-"
+                raise
+            except Exception as e:
+                print("Search error:", e)
+            return None
+
+        return call
+
+    def _sql_query(self, query, filter, fetch_size, ttl):
+        def _query(user, query, filter, fetch_size):
             # Run the query
             res = self.client.sql.query(
                 query=query,
                 filter=filter,
+                fetch_size=fetch_size,
+                # Bucket HISTOGRAM on local rather than UTC boundaries
+                time_zone=TIME_ZONE,
+                # Binary, column-major results skip JSON number parsing and
+                # transposing rows back into columns
+                format="cbor",
+                columnar=True,
             )
 
-            # Extract column names and rows
-            columns = [col["name"] for col in res["columns"]]
-            rows = res["rows"]
+            # Only the first page is ever read, so release any cursor left
+            # open on the server instead of letting it wait out its timeout.
+            # This is only cleanup, so it must never fail the query.
+            if res.body.get("cursor"):
+                try:
+                    self.client.sql.clear_cursor(cursor=res.body["cursor"])
+                except Exception as e:
+                    print("Clear cursor error:", e)
+
+            return res.body
+
+        return self._cached(_query, ttl)(query, filter, fetch_size)
+
+    def query(self, query, filter, fetch_size=None, ttl=QUERY_CACHE_TTL):
+        res = self._sql_query(query, filter, fetch_size, ttl)
+
+        if res is None:
+            return None
+
+        # Build the DataFrame column by column, typed from the SQL column
+        # metadata rather than inferred by pandas
+        data = {}
+        for col, values in zip(res["columns"], res["values"]):
+            if col["type"] == "datetime":
+                values = pd.to_datetime(values, utc=True, format="ISO8601")
+                values = values.tz_convert(TZ)
+            elif col["type"] in SQL_DTYPES:
+                values = pd.array(values, dtype=SQL_DTYPES[col["type"]])
+
+            data[col["name"]] = values
 
-            # Convert to DataFrame
-            return pd.DataFrame(rows, columns=columns)
-        except AuthenticationException as e:
-            pass
-        except Exception as e:
-            print("Search error:", e)
-        return None
+        return pd.DataFrame(data)
+
+    def fetchone(self, query, filter, ttl=QUERY_CACHE_TTL):
+        # Single-row results are read straight off the response as a
+        # {column: value} dict, without building a DataFrame
+        res = self._sql_query(query, filter, 1, ttl)
+
+        if res is None or not any(res["values"]):
+            return None
+
+        return {
+            col["name"]: values[0] for col, values in zip(res["columns"], res["values"])
+        }
+
+    def aggregate(self, index, aggs, filter, ttl=QUERY_CACHE_TTL):
+        def _aggregate(user, index, aggs, filter):
+            # Only the aggregations are read, so leave out took, _shards and
+            # hits metadata from the response
+            res = self.client.search(
+                index=index,
+                query=filter,
+                aggs=aggs,
+                size=0,
+                filter_path=["aggregations"],
+            )
+
+            return res.body["aggregations"]
+
+        return self._cached(_aggregate, ttl)(index, aggs, filter)
 
     def get_info(self):
         try:
@@ -121,18 +243,22 @@ def refresh(refresh_token: str):
     return response.json()
 
 
-def configure_filters(date=None, reporting_group=None):
+def configure_filters(date=None, reporting_group=None, since=None):
     filters = []
 
-    if not date:
-        date = "today/d"
+    # Half-open [start of day, start of next day) range, so the bounds only
+    # change once a day and Elasticsearch can reuse its cached filter
+    if date:
+        day_start, day_end = f"{date}", f"{date}||+1d"
+    else:
+        day_start, day_end = "now/d", "now+1d/d"
 
     filters.append(
         {
             "range": {
                 "@timestamp": {
-                    "gte": date,
-                    "lte": date,
+                    "gte": day_start,
+                    "lt": day_end,
                     "time_zone": TIME_ZONE,
                 }
             }
@@ -142,6 +268,9 @@ def configure_filters(date=None, reporting_group=None):
     if reporting_group:
         filters.append({"term": {"reporting.reporting_group": reporting_group}})
 
+    if since:
+        filters.append({"range": {"@timestamp": {"gte": since}}})
+
     return {"bool": {"must": filters}}
 
 
@@ -166,6 +295,24 @@ def logout_user():
     )
 
 
+def refresh_session():
+    # Nothing to refresh once logged out, and logging out again would fail
+    if not st.session_state.get("refresh_token"):
+        st.stop()
+
+    try:
+        refresh_res = refresh(st.session_state.get("refresh_token"))
+    except:
+        refresh_res = {"error": "refresh_failed"}
+
+    if refresh_res.get("error"):
+        logout_user()
+        st.stop()
+
+    st.session_state["access_token"] = refresh_res.get("access_token")
+    st.session_state["refresh_token"] = refresh_res.get("refresh_token")
+
+
 if (
     not st.session_state.get("access_token")
     and not st.session_state.get("refresh_token")
@@ -202,240 +349,289 @@ if not st.session_state.get("access_token") and not st.session_state.get(
     st.stop()
 
 
-adelaide_tz = pytz.timezone(TIME_ZONE)
-conn = st.connection(
-    "es", type=ElasticConnection, access_token=st.session_state["access_token"]
-)
+def connect():
+    # st.connection already shares one connection (and its client) per token
+    # across reruns and sessions; expire them so rotated tokens are released
+    return st.connection(
+        "es",
+        type=ElasticConnection,
+        ttl=CONNECTION_TTL,
+        access_token=st.session_state["access_token"],
+    )
+
+
+conn = connect()
 
 if conn.get_info() is None:
-    try:
-        refresh_res = refresh(st.session_state.get("refresh_token"))
+    refresh_session()
+    conn = connect()
 
-        if refresh_res.get("error"):
-            logout_user()
 
-        st.session_state["access_token"] = refresh_res.get("access_token")
-        st.session_state["refresh_token"] = refresh_res.get("refresh_token")
-        conn = st.connection(
-            "es", type=ElasticConnection, access_token=st.session_state["access_token"]
-        )
-    except:
-        logout_user()
+# === Queries ===
+TOP_LOCATIONS = 15
+TOP_PRODUCTS = 20
 
+# A full day of minute buckets fits in one page; the default of 1000 would
+# cut the chart off and leave the rest behind a cursor. Buckets are in local
+# time, so allow for the 25-hour day when daylight saving ends.
+MINUTES_PER_DAY = 25 * 60
 
-def total_sales_metric(filters):
-    res = conn.query(
-        query="""
-        SELECT
-            sum("data.transaction_value.total_ex") as "total_sales" 
-        FROM
-            "*-retail-transactions"
-        """,
-        filter=filters,
-    )
+SQL_TRANSACTION_METRICS = """
+    SELECT
+        HISTOGRAM("@timestamp",INTERVAL 1 HOUR) as "datetime",
+        sum("data.transaction_value.total_ex") as "sale_total"
+    FROM
+        "*-retail-transactions"
+    WHERE
+        "data.transaction_value.total_ex" != 0
+    GROUP BY
+        "datetime"
+    ORDER BY
+        sum("data.transaction_value.total_ex") desc
+    """
 
-    try:
-        total_sales = res.loc[0, "total_sales"]
-        total_sales = f"${round(total_sales):,}"
+# Run these with an @timestamp range filter for the active window. The
+# total is its own distinct count, since a terminal can appear under more
+# than one location and adding up the per-location counts would count it twice.
+SQL_ACTIVE_TERMINAL_COUNT = """
+    SELECT
+        count(DISTINCT "data.transaction.terminal.id") as "swiftpos_terminals",
+        count(DISTINCT "data.transaction.kiosk_id") as "mashgin_terminals"
+    FROM
+        "*-retail-product"
+    WHERE
+        "data.total_ex" != 0
+    """
 
-    except:
-        total_sales = "-"
+SQL_ACTIVE_TERMINALS = """
+    SELECT
+        "data.location.name" as "Location",
+        count(DISTINCT "data.transaction.terminal.id") as "swiftpos_terminals",
+        count(DISTINCT "data.transaction.kiosk_id") as "mashgin_terminals"
+    FROM
+        "*-retail-product"
+    WHERE
+        "data.total_ex" != 0
+    GROUP BY
+        "data.location.name"
+    """
 
-    return st.metric(
-        label="Total Sales (ex GST)",
-        value=total_sales,
-        border=True,
-    )
+SQL_SALES_BY_LOCATION = f"""
+    SELECT
+        "data.location.name" as "Location",
+        sum(CASE
+            WHEN "data.master_group.id" = '20' THEN "data.total_ex"
+            ELSE 0
+        END) as "Beverage",
+        sum(CASE
+            WHEN "data.master_group.id" = '10' THEN "data.total_ex"
+            ELSE 0
+        END) as "Food",
+        sum("data.total_ex") as "Total"
+    FROM
+        "*-retail-product"
+    WHERE
+        "data.total_ex" != 0 and "data.master_group.id" IN ('10', '20')
+    GROUP BY
+        "data.location.id", "data.location.name"
+    ORDER BY
+        sum("data.total_ex") desc
+    LIMIT {TOP_LOCATIONS}
+    """
 
+SQL_SALES_BY_TIMESTAMP = """
+    SELECT
+        HISTOGRAM("@timestamp",INTERVAL 1 MINUTE) as "datetime",
+        sum("data.transaction_value.total_ex") as "sale_total"
+    FROM
+        "*-retail-transactions"
+    WHERE
+        "data.transaction_value.total_ex" != 0
+    GROUP BY
+        "datetime"
+    """
 
-def highest_hour_metric(filters):
-    res = conn.query(
-        query="""
-        SELECT 
-            HISTOGRAM("@timestamp",INTERVAL 1 HOUR) as "datetime", 
-            sum("data.transaction_value.total_ex") as "sale_total",
-            count(DISTINCT "data.id") as "txn_total" 
-        FROM
-            "*-retail-transactions" 
-        WHERE 
-            "data.transaction_value.total_ex" != 0 
-        GROUP BY 
-            "datetime" 
-        ORDER BY 
-            sum("data.transaction_value.total_ex") desc 
-        LIMIT 1
-        """,
-        filter=filters,
-    )
+FOOD_AND_BEVERAGE = {"terms": {"data.master_group.id": ["10", "20"]}}
+
+# A terms aggregation ranks products on the shards and returns only the top
+# buckets, where SQL's GROUP BY would page through every product first
+AGGS_SALES_BY_PRODUCT = {
+    "products": {
+        "terms": {
+            "field": "data.name.keyword",
+            "size": TOP_PRODUCTS,
+            "order": {"total": "desc"},
+        },
+        "aggs": {
+            "quantity": {"sum": {"field": "data.quantity"}},
+            "total": {"sum": {"field": "data.total_ex"}},
+        },
+    }
+}
+
+SQL_VISITATION = """
+    SELECT
+        count("data.barcode") as entries
+    FROM
+        "ticketek-customer-attendance"
+    WHERE
+        "data.status.type" = 'Entry' and "data.priceTypeName" != 'TICKETEK TEST'
+    """
+
+
+@st.cache_resource
+def get_query_executor() -> ThreadPoolExecutor:
+    # One pool for every session, so a refresh doesn't start threads of its own
+    return ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+
+def run_queries(filters, active_filters, visitation_filters, ttl=QUERY_CACHE_TTL):
+    executor = get_query_executor()
+    ctx = get_script_run_ctx()
+
+    def submit(fn, *args, **kwargs):
+        # Pool threads outlive this run, so give each task the run's context
+        # for the query cache to work from them
+        def task():
+            add_script_run_ctx(ctx=ctx)
+            return fn(*args, **kwargs)
+
+        return executor.submit(task)
+
+    # The queries are independent, so issue them concurrently and wait on
+    # the slowest one rather than paying for each round-trip in turn.
+    futures = {
+        "transactions": submit(conn.query, SQL_TRANSACTION_METRICS, filters, ttl=ttl),
+        "active_terminal_count": submit(
+            conn.fetchone, SQL_ACTIVE_TERMINAL_COUNT, active_filters, ttl=ttl
+        ),
+        "active_terminals": submit(
+            conn.query, SQL_ACTIVE_TERMINALS, active_filters, ttl=ttl
+        ),
+        "sales_by_location": submit(
+            conn.query,
+            SQL_SALES_BY_LOCATION,
+            filters,
+            fetch_size=TOP_LOCATIONS,
+            ttl=ttl,
+        ),
+        "sales_by_timestamp": submit(
+            conn.query,
+            SQL_SALES_BY_TIMESTAMP,
+            filters,
+            fetch_size=MINUTES_PER_DAY,
+            ttl=ttl,
+        ),
+        "sales_by_product": submit(
+            conn.aggregate,
+            "swiftpos-retail-product",
+            AGGS_SALES_BY_PRODUCT,
+            {"bool": {"must": [filters, FOOD_AND_BEVERAGE]}},
+            ttl=ttl,
+        ),
+        "visitation": submit(
+            conn.fetchone, SQL_VISITATION, visitation_filters, ttl=ttl
+        ),
+    }
+
+    return {name: future.result() for name, future in futures.items()}
 
-    try:
-        hour = res.loc[0, "datetime"]
-        hour_utc = datetime.fromisoformat(hour.replace("Z", "+00:00"))
-        adelaide_time = hour_utc.astimezone(ZoneInfo("Australia/Adelaide"))
-        highest_hour = adelaide_time.strftime("%-I %p")
-    except:
-        highest_hour = "-"
-
-    return st.metric(label="Highest Hour", value=highest_hour, border=True)
-
-
-def active_terminals_metric(filters):
-    res = conn.query(
-        query="""
-        SELECT 
-            count(DISTINCT "data.transaction.terminal.id") as "swiftpos_terminals",
-            count(DISTINCT "data.transaction.kiosk_id") as "mashgin_terminals"
-        FROM
-            "*-retail-product"
-        WHERE
-            "@timestamp" > DATEADD('minutes', -15, NOW()) and "data.total_ex" != 0
-        """,
-        filter=filters,
-    )
 
+def render_metric(label, res, formatter):
     try:
-        active_terminals = (
-            res.loc[0, "swiftpos_terminals"] + res.loc[0, "mashgin_terminals"]
-        )
+        value = formatter(res)
     except:
-        active_terminals = "-"
-
-    return st.metric(label="Active Terminals", value=active_terminals, border=True)
-
-
-def sales_by_location_dataframe(filters):
-    sales_by_Location = conn.query(
-        query="""
-        SELECT
-            "data.location.name" as "Location",
-            count(DISTINCT CASE 
-                WHEN "@timestamp" > DATEADD('minutes', -15, NOW()) THEN "data.transaction.terminal.id"
-                ELSE null
-            END) as "Active",
-            sum(CASE 
-                WHEN "data.master_group.id" = '20' THEN "data.total_ex"
-                ELSE 0
-            END) as "Beverage",
-            sum(CASE 
-                WHEN "data.master_group.id" = '10' THEN "data.total_ex"
-                ELSE 0
-            END) as "Food",
-            sum("data.total_ex") as "Total"
-        FROM 
-            "*-retail-product"
-        WHERE 
-            "data.total_ex" != 0 and "data.master_group.id" = '10' or "data.master_group.id" = '20'
-        GROUP BY
-            "data.location.id", "data.location.name"
-        ORDER BY
-            sum("data.total_ex") desc
-        LIMIT 15
-        """,
-        filter=filters,
-    )
+        value = "-"
 
-    if sales_by_Location is not None and not sales_by_Location.empty:
+    return st.metric(label=label, value=value, border=True)
 
-        sales_by_Location = sales_by_Location.style.format(
-            {
-                "Beverage": lambda x: f"${x:,.0f}",
-                "Food": lambda x: f"${x:,.0f}",
-                "Total": lambda x: f"${x:,.0f}",
-            }
-        )
 
-        return st.dataframe(sales_by_Location, hide_index=True)
+def format_total_sales(res):
+    if res is None or res.empty:
+        return "-"
 
+    # The hourly buckets cover every non-zero sale, so they add up to the day.
+    return f"${round(res['sale_total'].sum()):,}"
 
-def sales_bar_chart(filters):
-    sales_by_timestamp = conn.query(
-        query="""
-    SELECT 
-        HISTOGRAM("@timestamp",INTERVAL 1 MINUTE) as "datetime", 
-        sum("data.transaction_value.total_ex") as "sale_total"
-    FROM
-        "*-retail-transactions" 
-    WHERE 
-        "data.transaction_value.total_ex" != 0 
-    GROUP BY 
-        "datetime" 
-    ORDER BY 
-        sum("data.transaction_value.total_ex") desc 
-    """,
-        filter=filters,
-    )
 
-    try:
-        sales_by_timestamp["datetime"] = pd.to_datetime(
-            sales_by_timestamp["datetime"], utc=True
-        )
-        sales_by_timestamp["datetime"] = sales_by_timestamp["datetime"].dt.tz_convert(
-            "Australia/Adelaide"
-        )
-    except:
-        return
+def format_highest_hour(res):
+    return res.loc[0, "datetime"].strftime("%-I %p")
 
-    if sales_by_timestamp.empty:
-        return
 
-    return st.bar_chart(
-        sales_by_timestamp,
-        x="datetime",
-        y="sale_total",
-        x_label="Time",
-        y_label="Sales (ex GST)",
-    )
+def format_active_terminals(res):
+    return res["swiftpos_terminals"] + res["mashgin_terminals"]
 
 
-def sales_by_product_dataframe(filters):
-    sales_by_product = conn.query(
-        query="""
-        SELECT
-            "data.name.keyword" as "Item",
-            sum("data.quantity") as "Qty Sold",
-            sum("data.total_ex") as "Total"
-        FROM
-            "swiftpos-retail-product"
-        WHERE 
-            "data.master_group.id" = '10' or "data.master_group.id" = '20'
-        GROUP BY 
-            "data.name.keyword"
-        ORDER BY 
-            sum("data.total_ex") desc
-        LIMIT 20
-        """,
-        filter=filters,
-    )
+def format_visitation(res):
+    return f"{res['entries']:,}"
 
-    if sales_by_product is not None and not sales_by_product.empty:
 
-        sales_by_product = sales_by_product.style.format(
-            {"Qty Sold": "{:,.0f}", "Total": lambda x: f"${x:,.0f}"}
+def sales_by_location_dataframe(sales_by_Location, active_terminals):
+    if sales_by_Location is not None and not sales_by_Location.empty:
+
+        # Active terminals come from their own query over the last few
+        # minutes, so the sales query doesn't evaluate a CASE per document
+        if active_terminals is not None:
+            active = active_terminals.set_index("Location")["swiftpos_terminals"]
+            sales_by_Location.insert(
+                1, "Active", sales_by_Location["Location"].map(active).fillna(0)
+            )
+
+        # Whole dollars, formatted through column_config so the columns stay
+        # numeric and sort by value rather than as text
+        money = ["Beverage", "Food", "Total"]
+        sales_by_Location[money] = sales_by_Location[money].round().astype("Int64")
+
+        return st.dataframe(
+            sales_by_Location,
+            hide_index=True,
+            column_config={
+                column: st.column_config.NumberColumn(
+                    f"{column} ($)", format="localized"
+                )
+                for column in money
+            },
         )
 
-        return st.dataframe(sales_by_product, hide_index=True)
 
+def sales_bar_chart(sales_by_timestamp):
+    if sales_by_timestamp is None or sales_by_timestamp.empty:
+        return
 
-def visitation_metric(filters):
-    res = conn.query(
-        query="""
-        SELECT 
-            count("data.barcode") as entries
-        FROM
-            "ticketek-customer-attendance"
-        WHERE
-            "data.status.type" = 'Entry' and "data.priceTypeName" != 'TICKETEK TEST'
-        """,
-        filter=filters,
+    chart = (
+        alt.Chart(sales_by_timestamp)
+        .mark_bar()
+        .encode(
+            x=alt.X("datetime:T", title="Time"),
+            y=alt.Y("sale_total:Q", title="Sales (ex GST)"),
+        )
     )
 
-    try:
-        visitation = res.loc[0, "entries"]
-        visitation = f"{visitation:,}"
-    except:
-        visitation = "-"
+    return st.altair_chart(chart, use_container_width=True)
 
-    return st.metric(label="Visitors", value=visitation, border=True)
+
+def sales_by_product_dataframe(aggregations):
+    buckets = aggregations["products"]["buckets"] if aggregations else None
+
+    if buckets:
+        sales_by_product = pd.DataFrame(
+            {
+                "Item": [bucket["key"] for bucket in buckets],
+                "Qty Sold": [bucket["quantity"]["value"] for bucket in buckets],
+                "Total": [bucket["total"]["value"] for bucket in buckets],
+            }
+        )
+
+        sales_by_product["Total"] = sales_by_product["Total"].round().astype("Int64")
+
+        return st.dataframe(
+            sales_by_product,
+            hide_index=True,
+            column_config={
+                "Qty Sold": st.column_config.NumberColumn(format="localized"),
+                "Total": st.column_config.NumberColumn("Total ($)", format="localized"),
+            },
+        )
 
 
 # Draw the actual page
@@ -449,47 +645,72 @@ with stylable_container(
     """,
 ):
     with st.popover("", icon=":material/settings:"):
-        refresh = st.toggle(value=True, label="Auto Refresh")
-        refresh_seconds = st.number_input(value=10, label="Refresh seconds")
+        refresh_toggle = st.toggle(value=True, label="Auto Refresh")
+        # Also the cache ttl, so it can't be zero or negative
+        refresh_seconds = st.number_input(
+            value=10, min_value=1, label="Refresh seconds"
+        )
         if st.button("Logout", icon=":material/logout:", type="tertiary"):
             logout_user()
+            # The token was just revoked, so don't query with it
+            st.stop()
 
 
 st.title("Skylight")
 
-date_filter = st.date_input("Pick a date", max_value=datetime.now(adelaide_tz), format="DD/MM/YYYY")
+date_filter = st.date_input(
+    "Pick a date", max_value=datetime.now(TZ), format="DD/MM/YYYY"
+)
 
 reporting_group = st.pills(
     "Filter data", options=["event_retail", "mtx_club_hotel"], default="event_retail"
 )
 
-if refresh:
+if refresh_toggle:
     st_autorefresh(interval=refresh_seconds * 1000, key="auto_refresh")
 
-filters = configure_filters(reporting_group=reporting_group, date=date_filter)
+filters_group = configure_filters(reporting_group=reporting_group, date=date_filter)
+filters_all = configure_filters(date=date_filter)
+filters_active = configure_filters(
+    reporting_group=reporting_group, date=date_filter, since="now-15m/m"
+)
+
+try:
+    results = run_queries(
+        filters=filters_group,
+        active_filters=filters_active,
+        visitation_filters=filters_all,
+        # Shorter than the refresh interval, so concurrent sessions share
+        # results but a session's own next tick always fetches new data
+        ttl=max(refresh_seconds / 2, 1),
+    )
+except AuthenticationException:
+    # The token expired since the check above; refresh it and start over
+    refresh_session()
+    st.rerun()
 
 col1, col2 = st.columns(2)
 
 with col1:
-    total_sales_metric(filters=filters)
-    highest_hour_metric(filters=filters)
+    render_metric("Total Sales (ex GST)", results["transactions"], format_total_sales)
+    render_metric("Highest Hour", results["transactions"], format_highest_hour)
 
 with col2:
-    visitation_metric(filters=configure_filters(date_filter))
-    active_terminals_metric(filters=filters)
+    render_metric("Visitors", results["visitation"], format_visitation)
+    render_metric(
+        "Active Terminals", results["active_terminal_count"], format_active_terminals
+    )
 
-sales_bar_chart(filters=filters)
+sales_bar_chart(results["sales_by_timestamp"])
 
 st.subheader("Top Locations")
-sales_by_location_dataframe(filters=filters)
+sales_by_location_dataframe(results["sales_by_location"], results["active_terminals"])
 
 st.subheader("Top Products")
-sales_by_product_dataframe(filters=filters)
+sales_by_product_dataframe(results["sales_by_product"])
 
 
-st.caption(
-    f"Last refresh: {datetime.now(adelaide_tz).strftime('%A, %d %B %Y %I:%M:%S %p')}"
-)
+st.caption(f"Last refresh: {datetime.now(TZ).strftime('%A, %d %B %Y %I:%M:%S %p')}")
 
 st.badge("Powered by Alkira Skylight", color="blue")
 